@@ -2,9 +2,20 @@ import streamlit as st
 import s3fs
 import pyarrow.parquet as pq
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
 import pandas as pd
 import numpy as np
 import os
+import json
+import hashlib
+import shutil
+import tempfile
+import time
+import math
+from collections import OrderedDict
+from urllib.parse import urlparse
 from datetime import datetime, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
@@ -35,11 +46,735 @@ def get_fs():
 
 fs = get_fs()
 
+@st.cache_resource
+def get_arrow_fs():
+    """S3 nativo do Arrow, usado para ler os Parquet (o s3fs fica para listagens)"""
+    # O pool de IO do Arrow é global do processo (compartilhado por todas as
+    # sessões), então o número de requisições simultâneas é definido uma vez só
+    pa.set_io_thread_count(int(os.getenv("TLC_REQUISICOES_PARALELAS", "16")))
+    endpoint = urlparse(os.getenv("MINIO_ENDPOINT", "http://minio:9000"))
+    return pafs.S3FileSystem(
+        access_key=os.getenv("MINIO_ROOT_USER", "minioadmin"),
+        secret_key=os.getenv("MINIO_ROOT_PASSWORD", "minioadmin"),
+        endpoint_override=endpoint.netloc,
+        scheme=endpoint.scheme or "http",
+        region=os.getenv("AWS_REGION", "us-east-1")
+    )
+
 # Configuração do bucket
 bucket_name = "trabalho"
 folder_path = "limpo/for_hire_2023"
 bucket_path = f"{bucket_name}/{folder_path}"
 
+# -----------------------------------------
+# 2. Schema canônico
+# -----------------------------------------
+# Todo arquivo (ou lote) é convertido para este schema no momento da leitura,
+# então a concatenação não precisa promover tipos e as páginas usam nomes fixos.
+SCHEMA_CANONICO = pa.schema([
+    ("dispatching_base_num", pa.string()),
+    ("pickup_datetime", pa.timestamp("us")),
+    ("dropoff_datetime", pa.timestamp("us")),
+    ("pu_location_id", pa.int32()),
+    ("do_location_id", pa.int32()),
+    ("sr_flag", pa.int32()),
+    ("affiliated_base_number", pa.string()),
+    ("trip_duration_min", pa.float64()),
+    ("pickup_date", pa.date32()),
+    ("pickup_year", pa.int32()),
+    ("pickup_month", pa.int32()),
+    ("pickup_hour", pa.int32()),
+    ("missing_pu_location", pa.bool_()),
+    ("missing_do_location", pa.bool_()),
+])
+
+# Variantes conhecidas (minúsculas) -> nome canônico.
+# Cobre os nomes brutos da TLC, o snake_case do Spark e meses antigos.
+ALIASES_COLUNAS = {
+    "dispatching_base_num": "dispatching_base_num",
+    "dispatching_base_number": "dispatching_base_num",
+    "pickup_datetime": "pickup_datetime",
+    "dropoff_datetime": "dropoff_datetime",
+    "pulocationid": "pu_location_id",
+    "pu_location_id": "pu_location_id",
+    "pickup_location_id": "pu_location_id",
+    "dolocationid": "do_location_id",
+    "do_location_id": "do_location_id",
+    "dropoff_location_id": "do_location_id",
+    "sr_flag": "sr_flag",
+    "affiliated_base_number": "affiliated_base_number",
+    "affiliated_base_num": "affiliated_base_number",
+    "trip_duration_min": "trip_duration_min",
+    "pickup_date": "pickup_date",
+    "pickup_year": "pickup_year",
+    "pickup_month": "pickup_month",
+    "pickup_hour": "pickup_hour",
+    "missing_pu_location": "missing_pu_location",
+    "missing_do_location": "missing_do_location",
+}
+
+# Colunas derivadas: calculadas a partir destas quando o arquivo não as traz
+DEPENDENCIAS_DERIVADAS = {
+    "trip_duration_min": ("pickup_datetime", "dropoff_datetime"),
+    "pickup_date": ("pickup_datetime",),
+    "pickup_year": ("pickup_datetime",),
+    "pickup_month": ("pickup_datetime",),
+    "pickup_hour": ("pickup_datetime",),
+    "missing_pu_location": ("pu_location_id",),
+    "missing_do_location": ("do_location_id",),
+}
+
+# Formato das datas no CSV original da TLC; o que não casar é lido como ISO 8601
+FORMATO_DATA_TLC = "%m/%d/%Y %I:%M:%S %p"
+
+def _converter_data(coluna, tipo):
+    """Converte datas em texto: formato da TLC e, para o resto, ISO 8601"""
+    if isinstance(coluna, pa.ChunkedArray):
+        return pa.chunked_array([_converter_data(c, tipo) for c in coluna.chunks], tipo)
+    tlc = pc.strptime(coluna, format=FORMATO_DATA_TLC, unit="us", error_is_null=True)
+    if tlc.null_count == coluna.null_count:
+        return tlc
+    falhas = pc.and_(pc.is_null(tlc), pc.is_valid(coluna))
+    # Cast seguro: um valor que não é nem TLC nem ISO falha, como nas outras colunas
+    iso = pc.cast(pc.filter(coluna, falhas), tipo)
+    return pc.replace_with_mask(tlc, falhas, iso)
+
+def _converter(coluna, tipo):
+    """Converte uma coluna para o tipo canônico"""
+    if coluna.type == tipo:
+        return coluna
+    if pa.types.is_timestamp(tipo):
+        if pa.types.is_string(coluna.type) or pa.types.is_large_string(coluna.type):
+            return _converter_data(coluna, tipo)
+        # ns -> us trunca frações de microssegundo, irrelevantes aqui
+        return pc.cast(coluna, tipo, safe=False)
+    return pc.cast(coluna, tipo)
+
+def _derivar(nome, base):
+    """Calcula uma coluna derivada a partir das colunas base já canônicas"""
+    pickup = base.get("pickup_datetime")
+    if nome == "trip_duration_min":
+        duracao = pc.subtract(base["dropoff_datetime"], pickup)
+        return pc.divide(pc.cast(duracao, pa.int64()), 60_000_000.0)
+    if nome == "pickup_date":
+        return pc.cast(pickup, pa.date32(), safe=False)
+    if nome == "pickup_year":
+        return pc.cast(pc.year(pickup), pa.int32())
+    if nome == "pickup_month":
+        return pc.cast(pc.month(pickup), pa.int32())
+    if nome == "pickup_hour":
+        return pc.cast(pc.hour(pickup), pa.int32())
+    if nome == "missing_pu_location":
+        return pc.is_null(base["pu_location_id"])
+    if nome == "missing_do_location":
+        return pc.is_null(base["do_location_id"])
+    raise KeyError(nome)
+
+def colunas_fisicas(nomes_arquivo, colunas=None):
+    """Nomes do arquivo necessários para produzir as colunas canônicas pedidas"""
+    if colunas is None:
+        colunas = SCHEMA_CANONICO.names
+    presentes = {ALIASES_COLUNAS.get(n.lower()) for n in nomes_arquivo}
+    necessarias = set(colunas)
+    for c in colunas:
+        if c not in presentes:
+            necessarias.update(DEPENDENCIAS_DERIVADAS.get(c, ()))
+    return [n for n in nomes_arquivo if ALIASES_COLUNAS.get(n.lower()) in necessarias]
+
+def canonizar(dados, colunas=None):
+    """Converte uma Table ou RecordBatch de qualquer variante conhecida para o schema canônico"""
+    schema = SCHEMA_CANONICO if colunas is None else pa.schema(
+        [SCHEMA_CANONICO.field(c) for c in colunas])
+    eh_tabela = isinstance(dados, pa.Table)
+
+    def nulos(tipo):
+        arr = pa.nulls(dados.num_rows, tipo)
+        return pa.chunked_array([arr], tipo) if eh_tabela else arr
+
+    # Renomeia e converte as colunas presentes no arquivo
+    base = {}
+    for nome in dados.schema.names:
+        canon = ALIASES_COLUNAS.get(nome.lower())
+        if canon and canon not in base:
+            base[canon] = _converter(dados.column(nome), SCHEMA_CANONICO.field(canon).type)
+
+    # Completa colunas derivadas ausentes e preenche o resto com nulos
+    for campo in schema:
+        if campo.name in base:
+            continue
+        deps = DEPENDENCIAS_DERIVADAS.get(campo.name)
+        if deps and all(d in base for d in deps):
+            base[campo.name] = _derivar(campo.name, base)
+        else:
+            base[campo.name] = nulos(campo.type)
+
+    arrays = [base[campo.name] for campo in schema]
+    if eh_tabela:
+        return pa.Table.from_arrays(arrays, schema=schema)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+# -----------------------------------------
+# 3. Agregação em streaming (out-of-core)
+# -----------------------------------------
+# No modo out-of-core a tabela completa nunca é materializada: as páginas
+# agregam lote a lote e o estado dos grupos vai para o disco se passar do orçamento.
+DIR_SPILL = os.getenv("TLC_SPILL_DIR", os.path.join(tempfile.gettempdir(), "tlc_spill"))
+N_PARTICOES_SPILL = 16
+ORCAMENTO_PADRAO_MB = 1024
+
+# Como os parciais de cada função são recombinados
+_REAGREGACAO = {"sum": "sum", "count": "sum", "count_all": "sum", "min": "min", "max": "max"}
+
+def linhas_por_lote(orcamento_mb):
+    """Tamanho de lote que cabe com folga no orçamento de memória"""
+    # ~256 bytes por linha já contando os temporários do group-by
+    return int(min(1_048_576, max(16_384, orcamento_mb * 1024**2 // 8 // 256)))
+
+def _agregar(tabela, chaves, metricas):
+    """Group-by de uma tabela; metricas = [(coluna, funcao, nome_saida)]"""
+    specs = []
+    nomes = {}
+    for coluna, funcao, nome in metricas:
+        if funcao == "count_all":
+            specs.append((coluna, "count", pc.CountOptions(mode="all")))
+            nomes[f"{coluna}_count"] = nome
+        else:
+            specs.append((coluna, funcao))
+            nomes[f"{coluna}_{funcao}"] = nome
+    resultado = tabela.group_by(chaves).aggregate(specs)
+    resultado = resultado.rename_columns([nomes.get(n, n) for n in resultado.column_names])
+    return resultado.select(chaves + [nome for _, _, nome in metricas])
+
+def _combinar(parciais, chaves, metricas):
+    """Recombina parciais já agregados com as mesmas chaves"""
+    reagregacao = [(nome, _REAGREGACAO[funcao], nome) for _, funcao, nome in metricas]
+    return _agregar(pa.concat_tables(parciais), chaves, reagregacao)
+
+def _derramar(parcial, chaves, dir_spill, seq):
+    """Particiona por hash das chaves e grava cada partição em disco"""
+    # Hash sobre a representação em texto: estável entre lotes com tipos pandas diferentes
+    texto = pa.table({c: pc.cast(parcial[c], pa.string()) for c in chaves}).to_pandas()
+    particao = pd.util.hash_pandas_object(texto, index=False).to_numpy() % N_PARTICOES_SPILL
+    for p in range(N_PARTICOES_SPILL):
+        pedaco = parcial.filter(pa.array(particao == p))
+        if pedaco.num_rows:
+            dir_p = os.path.join(dir_spill, f"p{p:02d}")
+            os.makedirs(dir_p, exist_ok=True)
+            pq.write_table(pedaco, os.path.join(dir_p, f"{seq:05d}.parquet"))
+
+def combinar_parciais(parciais, chaves, metricas, orcamento_mb):
+    """Combina parciais com memória limitada, derramando o estado em disco quando preciso"""
+    limite = orcamento_mb * 1024**2
+    pendentes, em_memoria = [], 0
+    dir_spill, seq = None, 0
+    try:
+        for parcial in parciais:
+            pendentes.append(parcial)
+            em_memoria += parcial.nbytes
+            if em_memoria <= limite:
+                continue
+            # Compacta; se os grupos continuarem grandes demais, vai para o disco
+            pendentes = [_combinar(pendentes, chaves, metricas)]
+            em_memoria = pendentes[0].nbytes
+            if em_memoria > limite / 2:
+                if dir_spill is None:
+                    os.makedirs(DIR_SPILL, exist_ok=True)
+                    dir_spill = tempfile.mkdtemp(prefix="agregado_", dir=DIR_SPILL)
+                _derramar(pendentes[0], chaves, dir_spill, seq)
+                seq += 1
+                pendentes, em_memoria = [], 0
+
+        if dir_spill is None:
+            if not pendentes:
+                raise ValueError("Nenhum dado para agregar")
+            return _combinar(pendentes, chaves, metricas)
+
+        if pendentes:
+            _derramar(_combinar(pendentes, chaves, metricas), chaves, dir_spill, seq)
+        # Cada partição tem chaves disjuntas: basta combinar uma por vez
+        resultados = []
+        for p in range(N_PARTICOES_SPILL):
+            dir_p = os.path.join(dir_spill, f"p{p:02d}")
+            if os.path.isdir(dir_p):
+                resultados.append(_combinar([pq.read_table(dir_p)], chaves, metricas))
+        return pa.concat_tables(resultados)
+    finally:
+        if dir_spill is not None:
+            shutil.rmtree(dir_spill, ignore_errors=True)
+
+def agregar_lotes(lotes, chaves, metricas, orcamento_mb, preparar=None):
+    """Agrega um iterador de tabelas canônicas, lote a lote"""
+    def parciais():
+        vazio, produziu = None, False
+        for lote in lotes:
+            if preparar is not None:
+                lote = preparar(lote)
+            if lote.num_rows:
+                produziu = True
+                yield _agregar(lote, chaves, metricas)
+            elif vazio is None:
+                vazio = lote
+        # Nenhuma linha: devolve o agregado vazio, mas com o schema certo
+        if not produziu and vazio is not None:
+            yield _agregar(vazio, chaves, metricas)
+    return combinar_parciais(parciais(), chaves, metricas, orcamento_mb)
+
+def iterar_lotes(fonte, colunas, arquivos=None):
+    """Percorre os dados carregados (ou só alguns arquivos) como tabelas canônicas"""
+    tamanho = linhas_por_lote(fonte['orcamento_mb'])
+    for caminho in (fonte['arquivos'] if arquivos is None else arquivos):
+        if fonte['modo'] == 'memoria':
+            yield st.session_state['tabelas_por_arquivo'][caminho].select(colunas)
+            continue
+        config = config_leitura()
+        dataset, metadata = abrir_parquet(caminho, config)
+        fisicas = colunas_fisicas(dataset.schema.names, colunas)
+        lotes = dataset.to_batches(
+            columns=fisicas, batch_size=tamanho, use_threads=True, batch_readahead=1,
+            fragment_readahead=row_groups_no_orcamento(metadata, fonte['orcamento_mb'], config)
+        )
+        for lote in lotes:
+            yield pa.Table.from_batches([canonizar(lote, colunas)])
+
+# -----------------------------------------
+# 4. Cache persistente de resultados
+# -----------------------------------------
+# Agregados e amostras ficam em disco (Arrow IPC), chaveados pela impressão
+# digital dos arquivos (caminho + ETag) e pelos parâmetros. Sobrevive a restarts
+# e é compartilhado entre sessões; a evicção é LRU por tamanho total.
+DIR_CACHE = os.getenv("TLC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tlc_fhv"))
+CACHE_MAX_MB = int(os.getenv("TLC_CACHE_MAX_MB", "2048"))
+# Incrementar quando o formato de algum resultado mudar
+VERSAO_CACHE = 3
+
+def impressao_arquivos(versoes):
+    """Impressão digital de um conjunto de arquivos: {caminho: versão (ETag)}"""
+    conteudo = json.dumps(sorted(versoes.items()))
+    return hashlib.sha256(conteudo.encode()).hexdigest()
+
+def versao_arquivo(info):
+    """Identifica o conteúdo de um objeto pela ETag (ou data de modificação e tamanho)"""
+    etag = info.get('ETag') or info.get('etag')
+    if etag:
+        return etag.strip('"')
+    return f"{info.get('LastModified') or info.get('mtime')}:{info.get('size')}"
+
+def chave_cache(impressao, tipo, params):
+    """Chave de um resultado: dados de entrada + tipo + parâmetros da página"""
+    conteudo = json.dumps([VERSAO_CACHE, impressao, tipo, params], sort_keys=True, default=str)
+    return hashlib.sha256(conteudo.encode()).hexdigest()
+
+def _caminho_cache(chave):
+    return os.path.join(DIR_CACHE, f"{chave}.arrow")
+
+def cache_ler(chave):
+    """Lê um resultado do cache (memory-mapped) ou None"""
+    caminho = _caminho_cache(chave)
+    try:
+        with pa.memory_map(caminho) as origem:
+            tabela = pa.ipc.open_file(origem).read_all()
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    try:
+        os.utime(caminho)  # marca como usado recentemente (LRU)
+    except FileNotFoundError:
+        pass  # evictado por outra sessão depois da leitura
+    return tabela
+
+def cache_gravar(chave, tabela):
+    """Grava um resultado no cache de forma atômica e aplica a evicção"""
+    os.makedirs(DIR_CACHE, exist_ok=True)
+    # Nome temporário único: as sessões do Streamlit são threads do mesmo processo
+    fd, temporario = tempfile.mkstemp(prefix=f"{chave}.", suffix=".tmp", dir=DIR_CACHE)
+    os.close(fd)
+    try:
+        with pa.OSFile(temporario, "wb") as destino:
+            with pa.ipc.new_file(destino, tabela.schema) as escritor:
+                escritor.write_table(tabela)
+        os.replace(temporario, _caminho_cache(chave))
+    except OSError:
+        # Outra sessão gravou o mesmo resultado (ou o disco falhou): o cache é opcional
+        try:
+            os.remove(temporario)
+        except FileNotFoundError:
+            pass
+        return
+    _evictar_cache()
+
+def _entradas_cache():
+    """(mtime, tamanho, caminho) de cada entrada do cache"""
+    entradas = []
+    if os.path.isdir(DIR_CACHE):
+        for nome in os.listdir(DIR_CACHE):
+            if nome.endswith(".arrow"):
+                caminho = os.path.join(DIR_CACHE, nome)
+                try:
+                    st_arquivo = os.stat(caminho)
+                except FileNotFoundError:
+                    continue
+                entradas.append((st_arquivo.st_mtime, st_arquivo.st_size, caminho))
+    return entradas
+
+def _evictar_cache():
+    """Remove as entradas menos usadas até caber em CACHE_MAX_MB"""
+    entradas = sorted(_entradas_cache())
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    limite = CACHE_MAX_MB * 1024**2
+    for _, tamanho, caminho in entradas:
+        if total <= limite:
+            break
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+
+def resumo_cache():
+    """Quantidade de entradas e tamanho total do cache em MB"""
+    entradas = _entradas_cache()
+    return len(entradas), sum(tamanho for _, tamanho, _ in entradas) / 1024**2
+
+def resultado_cacheado(impressao, tipo, params, calcular):
+    """Devolve o resultado (pa.Table) do cache em disco ou calcula e grava"""
+    chave = chave_cache(impressao, tipo, params)
+    tabela = cache_ler(chave)
+    if tabela is None:
+        tabela = calcular()
+        cache_gravar(chave, tabela)
+    return tabela
+
+# -----------------------------------------
+# 5. Atualização incremental
+# -----------------------------------------
+# Compara a listagem do bucket (ETags) com o que está carregado e relê só o que
+# mudou; os agregados por arquivo dos arquivos intactos vêm do cache em disco.
+@st.cache_data(ttl=60, show_spinner=False)
+def listar_versoes():
+    """{caminho: versão} dos Parquet no bucket (revalidado a cada minuto)"""
+    objetos = fs.ls(bucket_path, detail=True, refresh=True)
+    return {o['name']: versao_arquivo(o) for o in objetos if o['name'].endswith(".parquet")}
+
+def carregar_arquivo(caminho, out_of_core):
+    """Lê um arquivo no schema canônico: (tabela, linhas, estatísticas de leitura)"""
+    if out_of_core:
+        # Só o rodapé: os dados são lidos em streaming pelas páginas
+        with get_arrow_fs().open_input_file(caminho) as f:
+            return None, pq.read_metadata(f).num_rows, None
+    tabela, stats = ler_parquet(caminho)
+    return tabela, len(tabela), stats
+
+def diferenca_arquivos(fonte, atuais):
+    """(novos, alterados, removidos) entre o que está carregado e a listagem atual"""
+    carregados = fonte['versoes']
+    # Arquivos que falharam na leitura só voltam a contar quando a versão muda
+    ignorados = fonte.get('ignorados', {})
+    novos = [c for c in atuais if c not in carregados and (fonte['todos'] or c in ignorados)
+             and ignorados.get(c) != atuais[c]]
+    alterados = [c for c in carregados if c in atuais and atuais[c] != carregados[c]
+                 and ignorados.get(c) != atuais[c]]
+    removidos = [c for c in carregados if c not in atuais]
+    return sorted(novos), alterados, removidos
+
+def registrar_fonte(modo, versoes, linhas_por_arquivo, orcamento_mb, todos, tabelas=None,
+                    ignorados=None):
+    """Guarda a fonte carregada na sessão e descarta resultados derivados"""
+    arquivos = sorted(versoes)
+    for chave in ('arrow_table', 'tabelas_por_arquivo', 'agregados', 'df_view',
+                  'falhas_atualizacao', 'ordenacao_ooc', 'row_groups_ooc'):
+        st.session_state.pop(chave, None)
+    if tabelas is not None:
+        st.session_state['tabelas_por_arquivo'] = tabelas
+        # Schemas idênticos: concatenação só de metadados, sem cópia dos chunks
+        st.session_state['arrow_table'] = pa.concat_tables([tabelas[c] for c in arquivos])
+    st.session_state['fonte'] = {
+        'modo': modo,
+        'arquivos': arquivos,
+        'linhas': sum(linhas_por_arquivo.values()),
+        'linhas_por_arquivo': linhas_por_arquivo,
+        'orcamento_mb': int(orcamento_mb),
+        'versoes': versoes,
+        'impressao': impressao_arquivos(versoes),
+        'todos': todos,
+        # {caminho: versão} dos arquivos pulados por erro de leitura
+        'ignorados': dict(ignorados or {}),
+    }
+
+def atualizar_incremental(fonte, atuais):
+    """Lê só os arquivos novos/alterados, descarta os removidos e refaz a fonte
+
+    Um arquivo que falha não aborta a atualização: fica em fonte['ignorados'] até
+    mudar de versão e volta na lista de falhas. No modo em memória, um arquivo
+    alterado ilegível mantém a tabela anterior; no out-of-core (que relê o
+    arquivo a cada página) ele sai da fonte.
+    """
+    novos, alterados, removidos = diferenca_arquivos(fonte, atuais)
+    if len(removidos) == len(fonte['versoes']) and not novos:
+        raise ValueError("Nenhum dos arquivos carregados existe mais no bucket")
+    out_of_core = fonte['modo'] == 'out-of-core'
+    versoes = {c: v for c, v in fonte['versoes'].items() if c not in removidos}
+    linhas = {c: n for c, n in fonte['linhas_por_arquivo'].items() if c not in removidos}
+    ignorados = {c: v for c, v in fonte.get('ignorados', {}).items() if c in atuais}
+    tabelas = None
+    if not out_of_core:
+        tabelas = {c: t for c, t in st.session_state['tabelas_por_arquivo'].items()
+                   if c not in removidos}
+    falhas = []
+    for caminho in novos + alterados:
+        try:
+            tabela, n_linhas, _ = carregar_arquivo(caminho, out_of_core)
+        except Exception as e:
+            falhas.append({'arquivo': caminho.split('/')[-1], 'erro': str(e)[:100]})
+            ignorados[caminho] = atuais[caminho]
+            if out_of_core:
+                versoes.pop(caminho, None)
+                linhas.pop(caminho, None)
+            continue
+        ignorados.pop(caminho, None)
+        linhas[caminho] = n_linhas
+        versoes[caminho] = atuais[caminho]
+        if tabelas is not None:
+            tabelas[caminho] = tabela
+    if not versoes:
+        raise ValueError("Nenhum arquivo pôde ser lido na atualização")
+    registrar_fonte(fonte['modo'], versoes, linhas, fonte['orcamento_mb'], fonte['todos'],
+                    tabelas, ignorados)
+    return novos, alterados, removidos, falhas
+
+# -----------------------------------------
+# 6. Leitura Parquet otimizada
+# -----------------------------------------
+# Pre-buffering: os column chunks de cada row group são agrupados em poucas
+# requisições de faixa, disparadas em paralelo; cada row group vira um fragmento
+# e os fragmentos são decodificados em paralelo nos núcleos disponíveis.
+CONFIG_LEITURA_PADRAO = {
+    # Buracos até este tamanho entre column chunks são lidos junto (read-ahead)
+    'coalescer_kb': int(os.getenv("TLC_COALESCER_KB", "1024")),
+    # Tamanho máximo de cada requisição de faixa após a coalescência
+    'faixa_mb': int(os.getenv("TLC_FAIXA_MB", "32")),
+    'row_groups_paralelos': int(os.getenv("TLC_ROW_GROUPS_PARALELOS", str(os.cpu_count() or 4))),
+}
+
+def config_leitura():
+    """Configuração de leitura escolhida na página de carregamento (ou a padrão)"""
+    return st.session_state.get('config_leitura', CONFIG_LEITURA_PADRAO)
+
+def abrir_parquet(caminho, config):
+    """Dataset de um arquivo com um fragmento por row group, mais os metadados do rodapé"""
+    formato = ds.ParquetFileFormat(default_fragment_scan_options=ds.ParquetFragmentScanOptions(
+        pre_buffer=True,
+        cache_options=pa.CacheOptions(
+            hole_size_limit=config['coalescer_kb'] * 1024,
+            range_size_limit=config['faixa_mb'] * 1024**2,
+            lazy=False
+        )
+    ))
+    arquivo = formato.make_fragment(caminho, filesystem=get_arrow_fs())
+    row_groups = arquivo.split_by_row_group()
+    dataset = ds.FileSystemDataset(row_groups, arquivo.physical_schema, formato, get_arrow_fs())
+    return dataset, arquivo.metadata
+
+def row_groups_no_orcamento(metadata, orcamento_mb, config):
+    """Quantos row groups decodificar ao mesmo tempo sem estourar o orçamento"""
+    maior = max((metadata.row_group(r).total_byte_size for r in range(metadata.num_row_groups)),
+                default=1)
+    cabem = orcamento_mb * 1024**2 // 2 // max(maior, 1)
+    return int(max(1, min(config['row_groups_paralelos'], cabem)))
+
+def estimar_requisicoes(metadata, colunas, config):
+    """(requisições, bytes) da leitura das colunas, simulando a coalescência do pre-buffer"""
+    buraco = config['coalescer_kb'] * 1024
+    limite = config['faixa_mb'] * 1024**2
+    requisicoes, n_bytes = 1, 0  # rodapé
+    for r in range(metadata.num_row_groups):
+        row_group = metadata.row_group(r)
+        faixas = []
+        for i in range(row_group.num_columns):
+            chunk = row_group.column(i)
+            if chunk.path_in_schema not in colunas:
+                continue
+            inicio = chunk.data_page_offset
+            if chunk.has_dictionary_page and chunk.dictionary_page_offset:
+                inicio = min(inicio, chunk.dictionary_page_offset)
+            faixas.append((inicio, inicio + chunk.total_compressed_size))
+            n_bytes += chunk.total_compressed_size
+        # Junta faixas próximas, como o ReadRangeCache do Arrow
+        atual = None
+        for inicio, fim in sorted(faixas):
+            if atual and inicio - atual[1] <= buraco and fim - atual[0] <= limite:
+                atual = (atual[0], max(atual[1], fim))
+                continue
+            if atual:
+                requisicoes += math.ceil((atual[1] - atual[0]) / limite)
+            atual = (inicio, fim)
+        if atual:
+            requisicoes += math.ceil((atual[1] - atual[0]) / limite)
+    return requisicoes, n_bytes
+
+def ler_parquet(caminho, colunas=None):
+    """Lê um arquivo inteiro no schema canônico e mede o throughput"""
+    config = config_leitura()
+    inicio = time.perf_counter()
+    dataset, metadata = abrir_parquet(caminho, config)
+    fisicas = colunas_fisicas(dataset.schema.names, colunas)
+    tabela = dataset.to_table(columns=fisicas, use_threads=True,
+                              fragment_readahead=config['row_groups_paralelos'])
+    segundos = time.perf_counter() - inicio
+    requisicoes, n_bytes = estimar_requisicoes(metadata, set(fisicas), config)
+    stats = {
+        'mb_lidos': n_bytes / 1024**2,
+        'segundos': segundos,
+        'mb_s': n_bytes / 1024**2 / max(segundos, 1e-9),
+        'requisicoes': requisicoes,
+    }
+    return canonizar(tabela, colunas), stats
+
+# -----------------------------------------
+# 7. Navegação paginada
+# -----------------------------------------
+# Só as linhas da página visível são materializadas: slice/take zero-copy na
+# tabela em memória, ou leitura dos row groups necessários no modo out-of-core.
+# A ordenação usa uma permutação calculada uma vez por (dados, coluna).
+# No out-of-core, a permutação e os row groups em cache entram no orçamento da
+# sessão: uma permutação por vez e row groups limitados a uma fração do orçamento.
+TAMANHOS_PAGINA = [25, 50, 100, 250, 500]
+# Out-of-core ordenado: cada linha da página pode cair num row group diferente
+# (até uma leitura de row group por linha), então as páginas ficam menores
+TAMANHOS_PAGINA_ORDENADA_OOC = [25, 50]
+# Fração do orçamento reservada aos row groups decodificados em cache
+FRACAO_ROW_GROUPS = 0.25
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def indice_ordenacao(impressao, coluna):
+    """Permutação crescente da tabela em memória pela coluna (nulos no fim) e nº de nulos"""
+    valores = st.session_state['arrow_table'][coluna]
+    return pc.sort_indices(valores), valores.null_count
+
+def indice_ordenacao_ooc(fonte, coluna):
+    """Como indice_ordenacao, mas guardando uma única permutação na sessão"""
+    chave = (fonte['impressao'], coluna)
+    atual = st.session_state.get('ordenacao_ooc')
+    if atual is None or atual[0] != chave:
+        # Libera a permutação anterior antes de calcular a nova
+        st.session_state.pop('ordenacao_ooc', None)
+        valores = pa.concat_tables(iterar_lotes(fonte, [coluna]))[coluna]
+        atual = (chave, pc.sort_indices(valores), valores.null_count)
+        st.session_state['ordenacao_ooc'] = atual
+    return atual[1], atual[2]
+
+def cabe_ordenacao(fonte, coluna):
+    """No modo out-of-core, a ordenação precisa caber no orçamento fora dos row groups"""
+    if fonte['modo'] == 'memoria':
+        return True
+    tipo = SCHEMA_CANONICO.field(coluna).type
+    largura = 24 if pa.types.is_string(tipo) else max(1, tipo.bit_width // 8)
+    # Coluna + permutação final + buffer de 8 B/linha do merge dos chunks em sort_indices
+    pico = fonte['linhas'] * (largura + 16)
+    return pico <= fonte['orcamento_mb'] * 1024**2 * (1 - FRACAO_ROW_GROUPS)
+
+@st.cache_resource(show_spinner=False)
+def mapa_row_groups(impressao, _fonte):
+    """Primeira linha global de cada row group e o (arquivo, row group) correspondente"""
+    inicios, row_groups, total = [], [], 0
+    for caminho in _fonte['arquivos']:
+        with get_arrow_fs().open_input_file(caminho) as f:
+            metadata = pq.read_metadata(f)
+        for r in range(metadata.num_row_groups):
+            inicios.append(total)
+            row_groups.append((caminho, r))
+            total += metadata.row_group(r).num_rows
+    return np.array(inicios, dtype=np.int64), row_groups
+
+def ler_row_group(fonte, caminho, indice, colunas):
+    """Um row group no schema canônico, com cache LRU na sessão limitado pelo orçamento"""
+    cache = st.session_state.setdefault('row_groups_ooc', OrderedDict())
+    chave = (caminho, fonte['versoes'][caminho], indice, colunas)
+    if chave in cache:
+        cache.move_to_end(chave)
+        return cache[chave]
+    dataset, _ = abrir_parquet(caminho, config_leitura())
+    fragmento = list(dataset.get_fragments())[indice]
+    fisicas = colunas_fisicas(dataset.schema.names, list(colunas))
+    tabela = canonizar(fragmento.to_table(columns=fisicas), list(colunas))
+    cache[chave] = tabela
+    limite = fonte['orcamento_mb'] * 1024**2 * FRACAO_ROW_GROUPS
+    while cache and sum(t.nbytes for t in cache.values()) > limite:
+        cache.popitem(last=False)
+    return tabela
+
+def _ler_posicoes(fonte, posicoes, colunas):
+    """Linhas em posições globais arbitrárias, lendo só os row groups envolvidos"""
+    if len(posicoes) == 0:
+        return SCHEMA_CANONICO.empty_table().select(colunas)
+    inicios, row_groups = mapa_row_groups(fonte['impressao'], fonte)
+    grupo = np.searchsorted(inicios, posicoes, side='right') - 1
+    partes, ordem = [], []
+    for g in np.unique(grupo):
+        selecao = np.nonzero(grupo == g)[0]
+        caminho, indice = row_groups[g]
+        tabela = ler_row_group(fonte, caminho, int(indice), tuple(colunas))
+        partes.append(tabela.take(posicoes[selecao] - inicios[g]))
+        ordem.append(selecao)
+    juntas = pa.concat_tables(partes)
+    return juntas.take(np.argsort(np.concatenate(ordem)))
+
+def _take_por_chunk(tabela, posicoes):
+    """take que busca cada linha no seu chunk, sem concatenar colunas inteiras"""
+    # Table.take em colunas com vários chunks (um por arquivo/lote) concatena a
+    # coluna toda antes de buscar as linhas; aqui só as linhas da página são copiadas
+    posicoes = np.asarray(posicoes, dtype=np.int64)
+    colunas = []
+    for coluna in tabela.columns:
+        limites = np.cumsum([0] + [len(c) for c in coluna.chunks])
+        chunk = np.searchsorted(limites, posicoes, side='right') - 1
+        partes, ordem = [], []
+        for c in np.unique(chunk):
+            selecao = np.nonzero(chunk == c)[0]
+            partes.append(coluna.chunk(int(c)).take(pa.array(posicoes[selecao] - limites[c])))
+            ordem.append(selecao)
+        if partes:
+            valores = pa.concat_arrays(partes).take(pa.array(np.argsort(np.concatenate(ordem))))
+        else:
+            valores = pa.array([], coluna.type)
+        colunas.append(valores)
+    return pa.Table.from_arrays(colunas, schema=tabela.schema)
+
+def pagina_dados(fonte, inicio, tamanho, colunas, ordenar_por=None, decrescente=False):
+    """Linhas [inicio, inicio + tamanho) do dataset completo, opcionalmente ordenado"""
+    fim = min(inicio + tamanho, fonte['linhas'])
+    if ordenar_por is None:
+        posicoes = None
+    else:
+        if fonte['modo'] == 'memoria':
+            indices, nulos = indice_ordenacao(fonte['impressao'], ordenar_por)
+        else:
+            indices, nulos = indice_ordenacao_ooc(fonte, ordenar_por)
+        if decrescente:
+            # Lê a parte não nula da permutação de trás para frente (sem um segundo
+            # índice) e mantém os nulos no fim, como na ordem crescente
+            validos = fonte['linhas'] - nulos
+            partes = []
+            ate = min(fim, validos)
+            if inicio < ate:
+                partes.append(indices.slice(validos - ate, ate - inicio)[::-1])
+            de = max(inicio, validos)
+            if de < fim:
+                partes.append(indices.slice(de, fim - de))
+            posicoes = pa.concat_arrays(partes) if partes else pa.array([], pa.uint64())
+        else:
+            posicoes = indices.slice(inicio, fim - inicio)
+    
+    if fonte['modo'] == 'memoria':
+        tabela = st.session_state['arrow_table'].select(colunas)
+        if posicoes is None:
+            return tabela.slice(inicio, fim - inicio)
+        return _take_por_chunk(tabela, posicoes.to_numpy())
+    
+    if posicoes is None:
+        posicoes = np.arange(inicio, fim, dtype=np.int64)
+    else:
+        posicoes = posicoes.to_numpy().astype(np.int64)
+    return _ler_posicoes(fonte, posicoes, colunas)
+
 # -----------------------------------------
 # SIDEBAR - Navegação e Configurações
 # -----------------------------------------
@@ -69,20 +804,52 @@ with st.sidebar:
         - `dispatching_base_num`: Base que despachou
         - `pickup_datetime`: Data/hora do pickup
         - `dropoff_datetime`: Data/hora do dropoff
-        - `PULocationID`: Zona de pickup
-        - `DOLocationID`: Zona de dropoff
-        - `SR_Flag`: Viagem compartilhada (1) ou não (null)
+        - `pu_location_id`: Zona de pickup
+        - `do_location_id`: Zona de dropoff
+        - `sr_flag`: Viagem compartilhada (1) ou não (null)
         - `affiliated_base_number`: Base afiliada
+        - `trip_duration_min`: Duração da viagem (min)
+        - `pickup_date` / `pickup_hour`: Data e hora do pickup
+        
+        Variantes de nome (brutas da TLC, Spark, meses antigos)
+        são convertidas para este schema na leitura.
         """)
     
     # Status dos dados
-    if 'arrow_table' in st.session_state or 'df' in st.session_state:
+    if 'fonte' in st.session_state:
+        fonte = st.session_state['fonte']
         st.success("✅ Dados carregados")
-        if 'arrow_table' in st.session_state:
-            total_rows = len(st.session_state['arrow_table'])
-        else:
-            total_rows = len(st.session_state['df'])
-        st.metric("Total de viagens", f"{total_rows:,}")
+        st.metric("Total de viagens", f"{fonte['linhas']:,}")
+        if fonte['modo'] == 'out-of-core':
+            st.caption(f"🧠 Out-of-core · orçamento de {fonte['orcamento_mb']:,} MB")
+        
+        # Indicador de dados desatualizados em relação ao bucket
+        try:
+            novos, alterados, removidos = diferenca_arquivos(fonte, listar_versoes())
+        except Exception:
+            novos, alterados, removidos = [], [], []
+        if novos or alterados or removidos:
+            st.warning(f"🔄 Dados desatualizados: {len(novos)} novo(s), "
+                       f"{len(alterados)} alterado(s), {len(removidos)} removido(s)")
+            if st.button("🔄 Atualizar incrementalmente", use_container_width=True):
+                listar_versoes.clear()
+                try:
+                    with st.spinner("Lendo só os arquivos que mudaram..."):
+                        *_, falhas = atualizar_incremental(fonte, listar_versoes())
+                    if falhas:
+                        st.session_state['falhas_atualizacao'] = falhas
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ Erro na atualização: {str(e)}")
+        
+        if st.session_state.get('falhas_atualizacao'):
+            falhas = st.session_state['falhas_atualizacao']
+            with st.expander(f"⚠️ {len(falhas)} arquivo(s) com erro na atualização"):
+                st.dataframe(pd.DataFrame(falhas), use_container_width=True)
+                st.caption("Ficam de fora até o arquivo mudar no bucket.")
+        
+        n_cache, mb_cache = resumo_cache()
+        st.caption(f"🗄️ Cache: {n_cache} resultado(s) · {mb_cache:.0f}/{CACHE_MAX_MB:,} MB")
     else:
         st.warning("⚠️ Carregue os dados primeiro")
 
@@ -95,8 +862,7 @@ if pagina == "🏠 Carregar Dados":
     # Listar arquivos
     def listar_parquets():
         try:
-            all_files = fs.ls(bucket_path, detail=False)
-            return [f for f in all_files if f.endswith(".parquet")]
+            return sorted(listar_versoes())
         except Exception as e:
             st.error(f"❌ Erro ao listar arquivos: {str(e)}")
             return []
@@ -125,7 +891,35 @@ if pagina == "🏠 Carregar Dados":
                                help="Muito mais rápido e eficiente em memória!")
     with col2:
         show_details = st.checkbox("📝 Mostrar detalhes do carregamento", value=False)
-        unify_schemas = st.checkbox("🔧 Unificar schemas diferentes", value=True)
+        out_of_core = st.checkbox("🧠 Modo out-of-core", value=False,
+                                  help="Não materializa a tabela: as páginas agregam os arquivos "
+                                       "em streaming, lote a lote. Use para o ano completo ou vários anos.")
+    
+    with st.expander("🛰️ Leitura Parquet (avançado)"):
+        col_l1, col_l2, col_l3 = st.columns(3)
+        with col_l1:
+            coalescer_kb = st.number_input(
+                "Read-ahead entre chunks (KB)", 0, 65536, CONFIG_LEITURA_PADRAO['coalescer_kb'],
+                help="Column chunks separados por até este tamanho são lidos numa só requisição.")
+        with col_l2:
+            faixa_mb = st.number_input(
+                "Tamanho máx. de requisição (MB)", 1, 1024, CONFIG_LEITURA_PADRAO['faixa_mb'])
+        with col_l3:
+            row_groups_paralelos = st.number_input(
+                "Row groups em paralelo", 1, 256, CONFIG_LEITURA_PADRAO['row_groups_paralelos'])
+        st.session_state['config_leitura'] = {
+            'coalescer_kb': int(coalescer_kb),
+            'faixa_mb': int(faixa_mb),
+            'row_groups_paralelos': int(row_groups_paralelos),
+        }
+        st.caption(f"Requisições simultâneas: {pa.io_thread_count()} "
+                   "(global do processo; defina com `TLC_REQUISICOES_PARALELAS`).")
+    
+    orcamento_mb = st.number_input(
+        "💾 Orçamento de memória (MB)", 64, 262144, ORCAMENTO_PADRAO_MB, step=256,
+        help="Limite para lotes e estado das agregações; o excedente vai para o disco local.",
+        disabled=not out_of_core
+    )
     
     # Seleção de quantidade
     st.markdown("**Quantos arquivos carregar?**")
@@ -160,9 +954,12 @@ if pagina == "🏠 Carregar Dados":
         try:
             progress_bar = st.progress(0)
             status_text = st.empty()
-            tables = []
+            tabelas = {}
+            versoes = {}
+            linhas_por_arquivo = {}
             arquivos_ok = []
             arquivos_com_erro = []
+            ignorados = {}
             
             # Carrega cada arquivo
             for i, parquet_path in enumerate(arquivos_para_carregar):
@@ -171,66 +968,81 @@ if pagina == "🏠 Carregar Dados":
                 progress_bar.progress((i + 1) / len(arquivos_para_carregar))
                 
                 try:
-                    with fs.open(parquet_path, "rb") as f:
-                        file_info = fs.info(parquet_path)
-                        file_size_mb = file_info['size'] / (1024 * 1024)
-                        
-                        first_bytes = f.read(4)
-                        if first_bytes != b'PAR1':
-                            raise ValueError(f"Arquivo não é Parquet válido")
-                        f.seek(0)
-                        
-                        table = pq.read_table(f)
-                        tables.append(table)
-                        
-                        arquivos_ok.append({
-                            'arquivo': filename,
-                            'linhas': len(table),
-                            'tamanho_mb': f"{file_size_mb:.2f}"
+                    file_info = fs.info(parquet_path)
+                    file_size_mb = file_info['size'] / (1024 * 1024)
+                    
+                    table, linhas, leitura = carregar_arquivo(parquet_path, out_of_core)
+                    if table is not None:
+                        tabelas[parquet_path] = table
+                    
+                    versoes[parquet_path] = versao_arquivo(file_info)
+                    linhas_por_arquivo[parquet_path] = linhas
+                    arquivos_ok.append({
+                        'arquivo': filename,
+                        'linhas': linhas,
+                        'tamanho_mb': f"{file_size_mb:.2f}"
+                    })
+                    if leitura:
+                        arquivos_ok[-1].update({
+                            'segundos': round(leitura['segundos'], 2),
+                            'mb_s': round(leitura['mb_s'], 1),
+                            'requisicoes': leitura['requisicoes'],
                         })
+                    
+                    if show_details:
+                        detalhe = f" · {leitura['mb_s']:.0f} MB/s, {leitura['requisicoes']} requisições" if leitura else ""
+                        st.write(f"✅ {filename} - {linhas:,} linhas{detalhe}")
                         
-                        if show_details:
-                            st.write(f"✅ {filename} - {len(table):,} linhas")
-                            
                 except Exception as e:
                     arquivos_com_erro.append({'arquivo': filename, 'erro': str(e)[:100]})
+                    # Não reaparece como "novo" até a versão no bucket mudar
+                    ignorados[parquet_path] = listar_versoes().get(parquet_path)
                     if show_details:
                         st.warning(f"⚠️ Erro em {filename}")
                     if not skip_errors:
                         raise
             
-            if not tables:
+            if not versoes:
                 st.error("❌ Nenhum arquivo carregado!")
                 st.stop()
             
-            # Concatena
+            # Salva no session state (descarta agregados do carregamento anterior)
             status_text.text("Concatenando tabelas...")
-            if unify_schemas:
-                full_table = pa.concat_tables(tables, promote=True)
-            else:
-                full_table = pa.concat_tables(tables)
+            registrar_fonte(
+                'out-of-core' if out_of_core else 'memoria', versoes, linhas_por_arquivo,
+                orcamento_mb, todos=len(arquivos_para_carregar) == len(parquets),
+                tabelas=None if out_of_core else tabelas, ignorados=ignorados
+            )
+            total_linhas = st.session_state['fonte']['linhas']
+            memoria_mb = 0 if out_of_core else st.session_state['arrow_table'].nbytes / 1024**2
             
             progress_bar.progress(100)
             status_text.empty()
             
-            # Salva no session state
-            st.session_state['arrow_table'] = full_table
             st.session_state['arquivos_carregados'] = arquivos_ok
             st.session_state['arquivos_erro'] = arquivos_com_erro
             st.session_state['data_carregamento'] = datetime.now()
             
-            st.success(f"✅ **{len(full_table):,} viagens** carregadas com sucesso!")
+            st.success(f"✅ **{total_linhas:,} viagens** carregadas com sucesso!")
             
             # Estatísticas
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                st.metric("Viagens", f"{len(full_table):,}")
+                st.metric("Viagens", f"{total_linhas:,}")
             with col2:
                 st.metric("Arquivos", f"{len(arquivos_ok)}/{len(arquivos_para_carregar)}")
             with col3:
-                st.metric("Colunas", len(full_table.schema))
+                st.metric("Colunas", len(SCHEMA_CANONICO))
             with col4:
-                st.metric("Memória", f"{full_table.nbytes / 1024**2:.0f} MB")
+                if out_of_core:
+                    st.metric("Orçamento", f"{int(orcamento_mb):,} MB")
+                else:
+                    st.metric("Memória", f"{memoria_mb:.0f} MB")
+            
+            if not out_of_core:
+                with st.expander("📶 Throughput de leitura por arquivo"):
+                    st.dataframe(pd.DataFrame(arquivos_ok), use_container_width=True)
+                    st.caption("Requisições estimadas pela coalescência do pre-buffer sobre os metadados do arquivo.")
             
             if arquivos_com_erro:
                 with st.expander(f"⚠️ {len(arquivos_com_erro)} arquivo(s) com erro"):
@@ -247,63 +1059,184 @@ if pagina == "🏠 Carregar Dados":
 # -----------------------------------------
 # FUNÇÕES AUXILIARES PARA EDA
 # -----------------------------------------
-@st.cache_data
-def get_dataframe(_arrow_table, sample_size=None):
-    """Converte Arrow para Pandas, com opção de amostragem"""
-    if sample_size and len(_arrow_table) > sample_size:
-        # Amostra aleatória
-        indices = np.random.choice(len(_arrow_table), sample_size, replace=False)
-        indices = sorted(indices)
-        sampled = _arrow_table.take(indices)
-        return sampled.to_pandas()
-    return _arrow_table.to_pandas()
-
-@st.cache_data
-def processar_datas(_df):
-    """Processa e extrai features temporais"""
-    df = _df.copy()
-    df['pickup_datetime'] = pd.to_datetime(df['pickup_datetime'])
-    df['dropoff_datetime'] = pd.to_datetime(df['dropoff_datetime'])
-    df['trip_duration_min'] = (df['dropoff_datetime'] - df['pickup_datetime']).dt.total_seconds() / 60
-    df['pickup_hour'] = df['pickup_datetime'].dt.hour
+def amostra_aleatoria(tabela, n_linhas):
+    """Amostra aleatória de uma tabela Arrow, preservando a ordem original"""
+    if len(tabela) <= n_linhas:
+        return tabela
+    indices = np.sort(np.random.choice(len(tabela), n_linhas, replace=False))
+    return tabela.take(indices)
+
+def processar_datas(df):
+    """Extrai features temporais que não fazem parte do schema canônico"""
+    # Duração, data, mês e hora já vêm do schema canônico
+    df = df.copy()
     df['pickup_day'] = df['pickup_datetime'].dt.day
-    df['pickup_month'] = df['pickup_datetime'].dt.month
     df['pickup_dayofweek'] = df['pickup_datetime'].dt.dayofweek
-    df['pickup_date'] = df['pickup_datetime'].dt.date
     return df
 
+def _calcular_amostra(fonte, n_linhas, aleatoria):
+    """Amostra (ou primeiras linhas) dos dados carregados, sem materializar a tabela"""
+    if fonte['modo'] == 'memoria':
+        table = st.session_state['arrow_table']
+        if aleatoria:
+            return amostra_aleatoria(table, n_linhas)
+        return table.slice(0, n_linhas)
+    
+    if not aleatoria:
+        partes, coletadas = [], 0
+        for lote in iterar_lotes(fonte, SCHEMA_CANONICO.names):
+            partes.append(lote)
+            coletadas += lote.num_rows
+            if coletadas >= n_linhas:
+                break
+        return pa.concat_tables(partes).slice(0, n_linhas)
+    
+    # Out-of-core: reservatório lote a lote. Cada linha recebe uma chave aleatória e
+    # ficam as n menores, o que dá uma amostra uniforme com exatamente n linhas
+    rng = np.random.default_rng()
+    amostra, chaves = None, np.empty(0)
+    for lote in iterar_lotes(fonte, SCHEMA_CANONICO.names):
+        chaves_lote = rng.random(lote.num_rows)
+        if len(chaves) >= n_linhas:
+            # Só entram as linhas que batem a maior chave do reservatório
+            entram = chaves_lote < chaves.max()
+            lote, chaves_lote = lote.filter(pa.array(entram)), chaves_lote[entram]
+        amostra = lote if amostra is None else pa.concat_tables([amostra, lote])
+        chaves = np.concatenate([chaves, chaves_lote])
+        if len(chaves) > n_linhas:
+            # Índices ordenados preservam a ordem original das linhas
+            manter = np.sort(np.argpartition(chaves, n_linhas - 1)[:n_linhas])
+            amostra, chaves = amostra.take(manter), chaves[manter]
+    return amostra if amostra is not None else SCHEMA_CANONICO.empty_table()
+
+def amostra_dataframe(fonte, n_linhas, aleatoria):
+    """Amostra dos dados carregados como DataFrame (cacheada em disco)"""
+    tabela = resultado_cacheado(
+        fonte['impressao'], 'amostra', {'linhas': n_linhas, 'aleatoria': aleatoria},
+        lambda: _calcular_amostra(fonte, n_linhas, aleatoria)
+    )
+    return tabela.to_pandas()
+
+# Histograma de duração: 50 faixas entre 0 e 120 min
+LIMITE_DURACAO_MIN = 120
+N_FAIXAS_DURACAO = 50
+
+def _faixas_duracao(tabela):
+    """Mantém 0 < duração < 120 min e calcula a faixa do histograma"""
+    duracao = tabela['trip_duration_min']
+    validas = pc.and_(pc.greater(duracao, 0), pc.less(duracao, LIMITE_DURACAO_MIN))
+    duracao = pc.filter(duracao, validas)
+    faixa = pc.floor(pc.multiply(duracao, N_FAIXAS_DURACAO / LIMITE_DURACAO_MIN))
+    return pa.table({'faixa_duracao': pc.cast(faixa, pa.int32())})
+
+def _metricas_viagem(chave):
+    """Contagem, soma/contagem de duração e viagens compartilhadas"""
+    return [
+        (chave, 'count_all', 'viagens'),
+        ('trip_duration_min', 'sum', 'duracao_soma'),
+        ('trip_duration_min', 'count', 'duracao_n'),
+        ('sr_flag', 'count', 'compartilhadas'),
+    ]
+
+# Agregados exatos sobre todos os dados; as páginas só plotam a partir deles
+AGREGADOS = {
+    'tempo': {
+        'colunas': ['pickup_date', 'pickup_hour', 'trip_duration_min', 'sr_flag'],
+        'chaves': ['pickup_date', 'pickup_hour'],
+        'metricas': _metricas_viagem('pickup_date'),
+    },
+    'bases': {
+        'colunas': ['dispatching_base_num', 'trip_duration_min', 'sr_flag'],
+        'chaves': ['dispatching_base_num'],
+        'metricas': _metricas_viagem('dispatching_base_num'),
+    },
+    'afiliadas': {
+        'colunas': ['affiliated_base_number'],
+        'chaves': ['affiliated_base_number'],
+        'metricas': [('affiliated_base_number', 'count_all', 'viagens')],
+    },
+    'duracao': {
+        'colunas': ['trip_duration_min'],
+        'chaves': ['faixa_duracao'],
+        'metricas': [('faixa_duracao', 'count_all', 'viagens')],
+        'preparar': _faixas_duracao,
+    },
+}
+
+def _agregado_arquivo(fonte, caminho, nome, params):
+    """Parcial de um único arquivo, cacheado pela versão (ETag) desse arquivo"""
+    spec = AGREGADOS[nome]
+    return resultado_cacheado(
+        impressao_arquivos({caminho: fonte['versoes'][caminho]}), 'agregado_arquivo', params,
+        lambda: agregar_lotes(
+            iterar_lotes(fonte, spec['colunas'], [caminho]), spec['chaves'], spec['metricas'],
+            fonte['orcamento_mb'], spec.get('preparar')
+        )
+    )
+
+def obter_agregado(nome):
+    """Agregado exato sobre os dados carregados (cache na sessão e em disco)"""
+    cache = st.session_state.setdefault('agregados', {})
+    if nome not in cache:
+        fonte = st.session_state['fonte']
+        spec = AGREGADOS[nome]
+        params = {'nome': nome, 'chaves': spec['chaves'], 'metricas': spec['metricas']}
+        # Combina os parciais por arquivo: após uma atualização incremental só os
+        # arquivos novos/alterados são agregados, e os removidos simplesmente saem
+        tabela = resultado_cacheado(
+            fonte['impressao'], 'agregado', params,
+            lambda: combinar_parciais(
+                (_agregado_arquivo(fonte, c, nome, params) for c in fonte['arquivos']),
+                spec['chaves'], spec['metricas'], fonte['orcamento_mb']
+            )
+        )
+        cache[nome] = tabela.to_pandas()
+    return cache[nome]
+
+def agregado_temporal():
+    """Agregado por (data, hora) com data/hora completas e dia da semana"""
+    tempo = obter_agregado('tempo').dropna(subset=['pickup_date', 'pickup_hour']).copy()
+    tempo['pickup_hour'] = tempo['pickup_hour'].astype(int)
+    tempo['pickup_datetime'] = (pd.to_datetime(tempo['pickup_date'])
+                                + pd.to_timedelta(tempo['pickup_hour'], unit='h'))
+    tempo['pickup_dayofweek'] = tempo['pickup_datetime'].dt.dayofweek
+    return tempo
+
+DIAS_SEMANA = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom']
+
 # -----------------------------------------
 # PÁGINA: VISÃO GERAL
 # -----------------------------------------
 if pagina == "📈 Visão Geral":
     st.title("📈 Visão Geral dos Dados")
     
-    if 'arrow_table' not in st.session_state:
+    if 'fonte' not in st.session_state:
         st.warning("⚠️ Carregue os dados primeiro na página inicial")
         st.stop()
     
-    table = st.session_state['arrow_table']
+    fonte = st.session_state['fonte']
     
     # KPIs principais
     st.subheader("📊 Principais Métricas")
     
-    # Processa amostra para cálculos rápidos
+    # Agregados exatos sobre todas as viagens carregadas
     with st.spinner("Processando dados..."):
-        df_sample = get_dataframe(table, sample_size=100000)
-        df_sample = processar_datas(df_sample)
+        tempo = agregado_temporal()
+        bases = obter_agregado('bases')
+        duracao = obter_agregado('duracao')
     
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total de Viagens", f"{len(table):,}")
+        st.metric("Total de Viagens", f"{fonte['linhas']:,}")
     with col2:
-        total_bases = df_sample['dispatching_base_num'].nunique()
+        total_bases = bases['dispatching_base_num'].notna().sum()
         st.metric("Bases Ativas", f"{total_bases:,}")
     with col3:
-        avg_duration = df_sample['trip_duration_min'].mean()
+        avg_duration = bases['duracao_soma'].sum() / bases['duracao_n'].sum()
         st.metric("Duração Média", f"{avg_duration:.1f} min")
     with col4:
-        shared_pct = (df_sample['sr_flag'].notna().sum() / len(df_sample)) * 100
+        shared_pct = (bases['compartilhadas'].sum() / bases['viagens'].sum()) * 100
         st.metric("Viagens Compartilhadas", f"{shared_pct:.1f}%")
     
     st.divider()
@@ -313,7 +1246,7 @@ if pagina == "📈 Visão Geral":
     
     with col_g1:
         st.subheader("📅 Viagens por Dia")
-        viagens_dia = df_sample.groupby('pickup_date').size().reset_index(name='viagens')
+        viagens_dia = tempo.groupby('pickup_date')['viagens'].sum().reset_index()
         fig = px.line(viagens_dia, x='pickup_date', y='viagens', 
                      title="Evolução Diária de Viagens")
         fig.update_layout(height=400)
@@ -321,7 +1254,7 @@ if pagina == "📈 Visão Geral":
     
     with col_g2:
         st.subheader("⏰ Viagens por Hora do Dia")
-        viagens_hora = df_sample.groupby('pickup_hour').size().reset_index(name='viagens')
+        viagens_hora = tempo.groupby('pickup_hour')['viagens'].sum().reset_index()
         fig = px.bar(viagens_hora, x='pickup_hour', y='viagens',
                     title="Distribuição por Hora")
         fig.update_layout(height=400)
@@ -331,7 +1264,8 @@ if pagina == "📈 Visão Geral":
     
     # Top bases
     st.subheader("🏆 Top 10 Bases Mais Ativas")
-    top_bases = df_sample['dispatching_base_num'].value_counts().head(10).reset_index()
+    top_bases = bases.dropna(subset=['dispatching_base_num']).nlargest(10, 'viagens')
+    top_bases = top_bases[['dispatching_base_num', 'viagens']]
     top_bases.columns = ['Base', 'Viagens']
     
     fig = px.bar(top_bases, x='Base', y='Viagens', 
@@ -343,22 +1277,21 @@ if pagina == "📈 Visão Geral":
     
     with col_d1:
         st.subheader("⏱️ Distribuição de Duração")
-        # Filtra outliers
-        duration_clean = df_sample[
-            (df_sample['trip_duration_min'] > 0) & 
-            (df_sample['trip_duration_min'] < 120)
-        ]['trip_duration_min']
-        
-        fig = px.histogram(duration_clean, nbins=50,
-                          title="Duração das Viagens (até 120 min)")
-        fig.update_layout(showlegend=False)
+        # Outliers já filtrados na agregação (0 < duração < 120 min)
+        largura = LIMITE_DURACAO_MIN / N_FAIXAS_DURACAO
+        hist = duracao.sort_values('faixa_duracao')
+        hist['duracao_min'] = (hist['faixa_duracao'] + 0.5) * largura
+        
+        fig = px.bar(hist, x='duracao_min', y='viagens',
+                    title="Duração das Viagens (até 120 min)")
+        fig.update_traces(width=largura)
+        fig.update_layout(showlegend=False, bargap=0)
         st.plotly_chart(fig, use_container_width=True)
     
     with col_d2:
         st.subheader("📆 Viagens por Dia da Semana")
-        dias_semana = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom']
-        viagens_dow = df_sample.groupby('pickup_dayofweek').size().reset_index(name='viagens')
-        viagens_dow['dia'] = viagens_dow['pickup_dayofweek'].map(lambda x: dias_semana[x])
+        viagens_dow = tempo.groupby('pickup_dayofweek')['viagens'].sum().reset_index()
+        viagens_dow['dia'] = viagens_dow['pickup_dayofweek'].map(lambda x: DIAS_SEMANA[x])
         
         fig = px.bar(viagens_dow, x='dia', y='viagens',
                     title="Distribuição Semanal")
@@ -370,20 +1303,17 @@ if pagina == "📈 Visão Geral":
 elif pagina == "🗓️ Análise Temporal":
     st.title("🗓️ Análise Temporal Detalhada")
     
-    if 'arrow_table' not in st.session_state:
+    if 'fonte' not in st.session_state:
         st.warning("⚠️ Carregue os dados primeiro")
         st.stop()
     
-    table = st.session_state['arrow_table']
-    
     with st.spinner("Processando análise temporal..."):
-        df_sample = get_dataframe(table, sample_size=200000)
-        df_sample = processar_datas(df_sample)
+        tempo = agregado_temporal()
     
     # Filtros de data
     st.sidebar.subheader("🔍 Filtros Temporais")
-    min_date = df_sample['pickup_date'].min()
-    max_date = df_sample['pickup_date'].max()
+    min_date = tempo['pickup_date'].min()
+    max_date = tempo['pickup_date'].max()
     
     date_range = st.sidebar.date_input(
         "Período",
@@ -393,12 +1323,12 @@ elif pagina == "🗓️ Análise Temporal":
     )
     
     if len(date_range) == 2:
-        df_filtered = df_sample[
-            (df_sample['pickup_date'] >= date_range[0]) &
-            (df_sample['pickup_date'] <= date_range[1])
-        ]
+        df_filtered = tempo[
+            (tempo['pickup_date'] >= date_range[0]) &
+            (tempo['pickup_date'] <= date_range[1])
+        ].copy()
     else:
-        df_filtered = df_sample
+        df_filtered = tempo
     
     # Série temporal completa
     st.subheader("📈 Série Temporal Completa")
@@ -406,13 +1336,13 @@ elif pagina == "🗓️ Análise Temporal":
     agregacao = st.selectbox("Agregação", ["Hora", "Dia", "Semana"])
     
     if agregacao == "Hora":
-        df_filtered['periodo'] = df_filtered['pickup_datetime'].dt.floor('H')
+        df_filtered['periodo'] = df_filtered['pickup_datetime']
     elif agregacao == "Dia":
-        df_filtered['periodo'] = df_filtered['pickup_datetime'].dt.date
+        df_filtered['periodo'] = df_filtered['pickup_date']
     else:
         df_filtered['periodo'] = df_filtered['pickup_datetime'].dt.to_period('W').dt.start_time
     
-    serie_temporal = df_filtered.groupby('periodo').size().reset_index(name='viagens')
+    serie_temporal = df_filtered.groupby('periodo')['viagens'].sum().reset_index()
     
     fig = go.Figure()
     fig.add_trace(go.Scatter(
@@ -452,19 +1382,22 @@ elif pagina == "🗓️ Análise Temporal":
     col1, col2 = st.columns(2)
     
     with col1:
-        periodo_counts = df_filtered['periodo_dia'].value_counts()
+        periodo_counts = df_filtered.groupby('periodo_dia')['viagens'].sum()
         fig = px.pie(values=periodo_counts.values, names=periodo_counts.index,
                     title="Distribuição por Período do Dia")
         st.plotly_chart(fig, use_container_width=True)
     
     with col2:
         # Heatmap hora x dia da semana
-        heatmap_data = df_filtered.groupby(['pickup_dayofweek', 'pickup_hour']).size().unstack(fill_value=0)
+        heatmap_data = df_filtered.pivot_table(
+            index='pickup_dayofweek', columns='pickup_hour', values='viagens',
+            aggfunc='sum', fill_value=0
+        ).reindex(range(7), fill_value=0)
         
         fig = go.Figure(data=go.Heatmap(
             z=heatmap_data.values,
             x=heatmap_data.columns,
-            y=['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom'],
+            y=DIAS_SEMANA,
             colorscale='Blues'
         ))
         
@@ -482,29 +1415,27 @@ elif pagina == "🗓️ Análise Temporal":
 if pagina == "🚗 Análise de Bases":
     st.title("🚗 Análise de Bases de Despacho")
     
-    if 'arrow_table' not in st.session_state:
+    if 'fonte' not in st.session_state:
         st.warning("⚠️ Carregue os dados primeiro")
         st.stop()
     
-    table = st.session_state['arrow_table']
-    
     with st.spinner("Processando análise de bases..."):
-        df_sample = get_dataframe(table, sample_size=200000)
-        df_sample = processar_datas(df_sample)
+        bases = obter_agregado('bases').dropna(subset=['dispatching_base_num'])
+        afiliadas = obter_agregado('afiliadas').dropna(subset=['affiliated_base_number'])
     
     # Estatísticas gerais
     st.subheader("📊 Estatísticas Gerais")
     
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total de Bases", df_sample['dispatching_base_num'].nunique())
+        st.metric("Total de Bases", len(bases))
     with col2:
-        st.metric("Bases Afiliadas", df_sample['affiliated_base_number'].nunique())
+        st.metric("Bases Afiliadas", len(afiliadas))
     with col3:
-        bases_shared = df_sample[df_sample['sr_flag'].notna()]['dispatching_base_num'].nunique()
+        bases_shared = (bases['compartilhadas'] > 0).sum()
         st.metric("Bases c/ Shared Rides", bases_shared)
     with col4:
-        avg_trips_per_base = len(df_sample) / df_sample['dispatching_base_num'].nunique()
+        avg_trips_per_base = bases['viagens'].sum() / len(bases)
         st.metric("Média viagens/base", f"{avg_trips_per_base:.0f}")
     
     st.divider()
@@ -514,13 +1445,12 @@ if pagina == "🚗 Análise de Bases":
     
     n_bases = st.slider("Número de bases a mostrar", 5, 50, 20)
     
-    base_stats = df_sample.groupby('dispatching_base_num').agg({
-        'pickup_datetime': 'count',
-        'trip_duration_min': 'mean',
-        'sr_flag': lambda x: x.notna().sum()
-    }).reset_index()
-    
-    base_stats.columns = ['Base', 'Total_Viagens', 'Duracao_Media', 'Viagens_Compartilhadas']
+    base_stats = pd.DataFrame({
+        'Base': bases['dispatching_base_num'],
+        'Total_Viagens': bases['viagens'],
+        'Duracao_Media': bases['duracao_soma'] / bases['duracao_n'],
+        'Viagens_Compartilhadas': bases['compartilhadas'],
+    })
     base_stats['Pct_Compartilhadas'] = (base_stats['Viagens_Compartilhadas'] / base_stats['Total_Viagens']) * 100
     base_stats = base_stats.sort_values('Total_Viagens', ascending=False).head(n_bases)
     
@@ -563,14 +1493,66 @@ if pagina == "🚗 Análise de Bases":
 elif pagina == "🔍 Dados Detalhados":
     st.title("🔍 Exploração Detalhada dos Dados")
     
-    if 'arrow_table' not in st.session_state:
+    if 'fonte' not in st.session_state:
         st.warning("⚠️ Carregue os dados primeiro")
         st.stop()
     
-    table = st.session_state['arrow_table']
+    fonte = st.session_state['fonte']
+    
+    # Navegação paginada sobre o dataset completo
+    st.subheader("📋 Navegação Paginada")
+    
+    col_p1, col_p2, col_p3, col_p4 = st.columns([3, 1, 1, 1])
+    with col_p1:
+        colunas_pagina = st.multiselect(
+            "Colunas a exibir",
+            SCHEMA_CANONICO.names,
+            default=SCHEMA_CANONICO.names[:7]
+        ) or SCHEMA_CANONICO.names
+    with col_p2:
+        ordenar_por = st.selectbox("Ordenar por", ['Nenhum'] + SCHEMA_CANONICO.names)
+    with col_p3:
+        decrescente = st.checkbox("Decrescente", value=True)
+    
+    if ordenar_por != 'Nenhum' and not cabe_ordenacao(fonte, ordenar_por):
+        st.warning("⚠️ A ordenação por esta coluna não cabe no orçamento de memória; "
+                   "mostrando a ordem original.")
+        ordenar_por = 'Nenhum'
+    
+    ordenado_ooc = ordenar_por != 'Nenhum' and fonte['modo'] != 'memoria'
+    with col_p4:
+        if ordenado_ooc:
+            tamanho_pagina = st.selectbox("Linhas por página", TAMANHOS_PAGINA_ORDENADA_OOC, index=0)
+        else:
+            tamanho_pagina = st.selectbox("Linhas por página", TAMANHOS_PAGINA, index=2)
+    
+    if ordenado_ooc:
+        st.info("ℹ️ No modo out-of-core, uma página ordenada lê um row group inteiro por linha "
+                "no pior caso (as linhas vizinhas na ordem costumam estar em arquivos diferentes). "
+                f"Por isso as páginas ficam limitadas a {max(TAMANHOS_PAGINA_ORDENADA_OOC)} linhas "
+                "e cada página pode levar alguns segundos; sem ordenação a leitura é sequencial.")
+    
+    n_paginas = max(1, math.ceil(fonte['linhas'] / tamanho_pagina))
+    pagina_atual = st.number_input(f"Página (de {n_paginas:,})", 1, n_paginas, 1)
+    inicio_pagina = (pagina_atual - 1) * tamanho_pagina
+    
+    spinner = "Ordenando o dataset completo (só na primeira vez)..." if ordenar_por != 'Nenhum' else "Lendo página..."
+    with st.spinner(spinner):
+        inicio_leitura = time.perf_counter()
+        tabela_pagina = pagina_dados(
+            fonte, inicio_pagina, tamanho_pagina, colunas_pagina,
+            None if ordenar_por == 'Nenhum' else ordenar_por, decrescente
+        )
+        ms_pagina = (time.perf_counter() - inicio_leitura) * 1000
+    
+    st.dataframe(tabela_pagina.to_pandas(), use_container_width=True, height=600)
+    st.caption(f"Linhas {inicio_pagina + 1:,}–{inicio_pagina + tabela_pagina.num_rows:,} "
+               f"de {fonte['linhas']:,} · página montada em {ms_pagina:.0f} ms")
+    
+    st.divider()
     
     # Opções de visualização
-    st.subheader("⚙️ Opções de Visualização")
+    st.subheader("⚙️ Amostra para Análise")
     
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -583,10 +1565,7 @@ elif pagina == "🔍 Dados Detalhados":
     # Buscar dados
     if st.button("🔍 Buscar Dados", type="primary"):
         with st.spinner("Carregando dados..."):
-            if random_sample:
-                df = get_dataframe(table, sample_size=n_rows)
-            else:
-                df = table.slice(0, n_rows).to_pandas()
+            df = amostra_dataframe(fonte, n_rows, random_sample)
             
             if processar_dates:
                 df = processar_datas(df)
@@ -636,80 +1615,44 @@ elif pagina == "🔍 Dados Detalhados":
         st.divider()
         st.subheader("🔎 Filtros Interativos")
         
-        # Mapeia nomes de colunas (case-insensitive)
-        cols_lower = {col.lower(): col for col in df.columns}
-        
-        base_col = cols_lower.get('dispatching_base_num')
-        sr_col = cols_lower.get('sr_flag')
-        pickup_col = cols_lower.get('pulocationid') or cols_lower.get('pickup_location_id')
-        
         col_f1, col_f2, col_f3 = st.columns(3)
         
+        # Colunas com nomes fixos do schema canônico
         with col_f1:
-            if base_col:
-                bases = ['Todas'] + sorted(df[base_col].unique().tolist())
-                base_selecionada = st.selectbox("Base de Despacho", bases)
-            else:
-                base_selecionada = None
+            bases = ['Todas'] + sorted(df['dispatching_base_num'].dropna().unique().tolist())
+            base_selecionada = st.selectbox("Base de Despacho", bases)
         
         with col_f2:
-            if sr_col:
-                shared_filter = st.selectbox("Tipo de Viagem", 
-                                            ["Todas", "Compartilhadas", "Não Compartilhadas"])
-            else:
-                shared_filter = None
+            shared_filter = st.selectbox("Tipo de Viagem", 
+                                        ["Todas", "Compartilhadas", "Não Compartilhadas"])
         
         with col_f3:
-            if pickup_col:
-                zonas = ['Todas'] + sorted([str(z) for z in df[pickup_col].unique()])
-                zona_selecionada = st.selectbox("Zona de Pickup", zonas)
-            else:
-                zona_selecionada = None
+            zonas = ['Todas'] + [str(int(z)) for z in sorted(df['pu_location_id'].dropna().unique())]
+            zona_selecionada = st.selectbox("Zona de Pickup", zonas)
         
         # Aplicar filtros
         df_filtered = df.copy()
         
-        if base_col and base_selecionada and base_selecionada != 'Todas':
-            df_filtered = df_filtered[df_filtered[base_col] == base_selecionada]
+        if base_selecionada != 'Todas':
+            df_filtered = df_filtered[df_filtered['dispatching_base_num'] == base_selecionada]
         
-        if sr_col and shared_filter:
-            if shared_filter == "Compartilhadas":
-                df_filtered = df_filtered[df_filtered[sr_col].notna()]
-            elif shared_filter == "Não Compartilhadas":
-                df_filtered = df_filtered[df_filtered[sr_col].isna()]
+        if shared_filter == "Compartilhadas":
+            df_filtered = df_filtered[df_filtered['sr_flag'].notna()]
+        elif shared_filter == "Não Compartilhadas":
+            df_filtered = df_filtered[df_filtered['sr_flag'].isna()]
         
-        if pickup_col and zona_selecionada and zona_selecionada != 'Todas':
-            df_filtered = df_filtered[df_filtered[pickup_col] == int(zona_selecionada)]
+        if zona_selecionada != 'Todas':
+            df_filtered = df_filtered[df_filtered['pu_location_id'] == int(zona_selecionada)]
         
         st.info(f"📊 Mostrando **{len(df_filtered):,}** de {len(df):,} registros")
         
-        # Visualização dos dados
-        st.divider()
-        st.subheader("📋 Dados")
-        
-        # Opções de exibição
-        col_d1, col_d2 = st.columns([3, 1])
-        with col_d1:
-            colunas_exibir = st.multiselect(
-                "Colunas a exibir",
-                df_filtered.columns.tolist(),
-                default=df_filtered.columns.tolist()[:7]
-            )
-        with col_d2:
-            ordenar_por = st.selectbox("Ordenar por", ['Nenhum'] + df_filtered.columns.tolist())
-        
-        # Preparar visualização
-        df_display = df_filtered[colunas_exibir] if colunas_exibir else df_filtered
-        
-        if ordenar_por != 'Nenhum':
-            df_display = df_display.sort_values(ordenar_por, ascending=False)
-        
-        # Mostrar tabela
-        st.dataframe(
-            df_display,
-            use_container_width=True,
-            height=600
+        # Colunas da amostra filtrada (a tabela completa está na navegação paginada acima)
+        colunas_exibir = st.multiselect(
+            "Colunas da seleção",
+            df_filtered.columns.tolist(),
+            default=df_filtered.columns.tolist()[:7]
         )
+        df_display = df_filtered[colunas_exibir] if colunas_exibir else df_filtered
         
         # Opções de download
         st.divider()
@@ -756,12 +1699,12 @@ elif pagina == "🔍 Dados Detalhados":
             with st.expander("📊 Análise Rápida da Seleção"):
                 col_a1, col_a2, col_a3 = st.columns(3)
                 
-                # Mapeia colunas
-                cols_lower = {col.lower(): col for col in df_display.columns}
-                duration_col = cols_lower.get('trip_duration_min')
-                base_col = cols_lower.get('dispatching_base_num')
-                pickup_col = cols_lower.get('pulocationid') or cols_lower.get('pickup_location_id')
-                sr_col = cols_lower.get('sr_flag')
+                # Só as colunas canônicas que estão sendo exibidas
+                exibidas = set(df_display.columns)
+                duration_col = 'trip_duration_min' if 'trip_duration_min' in exibidas else None
+                base_col = 'dispatching_base_num' if 'dispatching_base_num' in exibidas else None
+                pickup_col = 'pu_location_id' if 'pu_location_id' in exibidas else None
+                sr_col = 'sr_flag' if 'sr_flag' in exibidas else None
                 
                 with col_a1:
                     if duration_col: